@@ -3,30 +3,79 @@
 from __future__ import annotations
 
 import atexit
+import copyreg as _copyreg
 import datetime as _dt
+import functools as _functools
 import json as _json
 import os as _os
 import random as _random
+import sys as _sys
 import threading as _threading
 import time as _time
+from array import array as _array
 from pathlib import Path as _Path
 from typing import Any as _Any
 from typing import Dict as _Dict
 from typing import List as _List
 from typing import Optional as _Optional
 
-__all__ = ["install"]
+try:
+    import orjson as _orjson
+except ImportError:  # pragma: no cover - optional speedup
+    _orjson = None
+
+__all__ = ["install", "flush"]
+
+# The agent environment is fixed for the process lifetime, so it is read once at import.
+_ENV = _os.environ
+_ENABLED_FLAG = _ENV.get("AGENT_DETERMINISTIC")
+_ENABLED = _ENABLED_FLAG == "1" or (bool(_ENABLED_FLAG) and _ENABLED_FLAG.lower() == "true")
+_START_ENV = _ENV.get("AGENT_START_TIME")
+_SEED_ENV = _ENV.get("AGENT_SEED")
+_MODE_ENV = _ENV.get("AGENT_EXECUTION_MODE")
+_CLOCK_ENV = _ENV.get("AGENT_CLOCK_FILE")
+_EXPECTED_TICKS_ENV = _ENV.get("AGENT_EXPECTED_TICKS")
+
+# fromisoformat() accepts a trailing "Z" and most ISO 8601 forms from 3.11 onwards.
+_NATIVE_ISO_PARSE = _sys.version_info >= (3, 11)
 
 _INSTALL_FLAG = object()
+_REAL_DATETIME = _dt.datetime
+# Version of the "python" clock source written by this runtime; older sources get validated tick by tick.
+_SCHEMA_VERSION = 2
 _LOCK = _threading.RLock()
+# Serialises _advance only, separate from the install lock. Reentrant so a sleep from a
+# signal handler or __del__ that interrupts _advance cannot deadlock.
+_TICK_LOCK = _threading.RLock()
 _BASE_DT: _dt.datetime | None = None
 _BASE_SECONDS = 0.0
 _MONOTONIC_BASE = 0.0
+# Single-word and GIL-atomic: written under _TICK_LOCK by _advance, read lock-free everywhere else.
 _VIRTUAL_OFFSET = 0.0
-_RECORDED_TICKS: _Optional[_List[_Dict[str, _Any]]] = None
-_EMITTED_TICKS: _List[_Dict[str, _Any]] = []
+# datetime results memoised per offset; _advance drops them whenever the offset moves.
+_NOW_CACHE: tuple[float, _dt.datetime, _dt.datetime] | None = None
+# Keyed by id(tz): tzinfo equality ignores names (timezone.__eq__ compares offsets only) and
+# some tzinfos are unhashable. Each entry holds its tz, which also keeps the id from being reused.
+_TZ_NOW_CACHE: _Dict[int, tuple[_dt.tzinfo, float, _dt.datetime]] = {}
+# Callers often build a fresh tzinfo per now() call, so the cache is reset once it holds this many.
+_TZ_NOW_CACHE_SIZE = 8
+# Virtual "at" timestamps (ms) of the recorded ticks, in replay order.
+_RECORDED_AT: _Optional[_array] = None
+# The recording is immutable during replay, so its length is cached once at load.
+_RECORDED_LEN = 0
+_REPLAY_EXHAUSTED = "[dal-runtime-python] replay exceeded recorded clock ticks; diverging schedule detected"
+# Emitted ticks are stored column-wise; the sequence is the index and the op is always "sleep".
+_TICK_SECONDS = _array("d")
+_TICK_AT = _array("d")
+# Slots in use; the columns are grown ahead of it geometrically rather than per append.
+_TICK_COUNT = 0
+_TICK_CHUNK = 4096
+# Upper bound on the AGENT_EXPECTED_TICKS pre-size (16 MiB across both columns).
+_MAX_EXPECTED_TICKS = 1 << 20
 _TICK_INDEX = 0
 _CLOCK_FILE: _Path | None = None
+# Tick count at the last flush(); the exit hook skips work when nothing changed since.
+_FLUSHED_TICKS = -1
 _MODE: str = "record"
 _INITIAL_TIME_ISO: str = ""
 
@@ -36,13 +85,13 @@ def install() -> None:
 
     global _INSTALL_FLAG
 
+    if not _ENABLED:
+        return
+
     with _LOCK:
         if getattr(_time, "__dal_installed__", None) is _INSTALL_FLAG:
             return
 
-        if not _is_deterministic_enabled():
-            return
-
         _time.__dal_installed__ = _INSTALL_FLAG  # type: ignore[attr-defined]
 
         _initialise_clock_state()
@@ -51,50 +100,77 @@ def install() -> None:
         _register_persist()
 
 
-def _is_deterministic_enabled() -> bool:
-    flag = _os.environ.get("AGENT_DETERMINISTIC")
-    if not flag:
-        return False
-    return flag == "1" or flag.lower() == "true"
-
-
 def _initialise_clock_state() -> None:
-    global _BASE_DT, _BASE_SECONDS, _MONOTONIC_BASE, _CLOCK_FILE, _RECORDED_TICKS, _VIRTUAL_OFFSET, _TICK_INDEX, _MODE, _INITIAL_TIME_ISO
+    global _BASE_DT, _BASE_SECONDS, _MONOTONIC_BASE, _CLOCK_FILE, _RECORDED_AT, _RECORDED_LEN, _VIRTUAL_OFFSET, _TICK_INDEX, _MODE, _INITIAL_TIME_ISO
 
-    start_iso = _os.environ.get("AGENT_START_TIME")
-    base_dt = _parse_iso_timestamp(start_iso)
+    base_dt = _parse_iso_timestamp(_START_ENV)
     _INITIAL_TIME_ISO = base_dt.isoformat().replace("+00:00", "Z")
     _BASE_DT = base_dt
     _BASE_SECONDS = base_dt.timestamp()
     _MONOTONIC_BASE = 0.0
     _VIRTUAL_OFFSET = 0.0
     _TICK_INDEX = 0
-    _RECORDED_TICKS = None
+    _RECORDED_AT = None
+    _RECORDED_LEN = 0
+    _reserve_ticks(_expected_ticks())
 
-    _MODE = _normalise_mode(_os.environ.get("AGENT_EXECUTION_MODE"))
-    clock_env = _os.environ.get("AGENT_CLOCK_FILE")
-    _CLOCK_FILE = _Path(clock_env) if clock_env else _Path.cwd() / ".agent" / "clock.json"
+    _MODE = _normalise_mode(_MODE_ENV)
+    _CLOCK_FILE = _resolve_clock_file()
 
     if _MODE == "replay" and _CLOCK_FILE.exists():
         try:
-            data = _json.loads(_CLOCK_FILE.read_text(encoding="utf-8"))
+            data = _load_json(_CLOCK_FILE)
             sources = data.get("sources", {}) if isinstance(data, dict) else {}
             node = sources.get("python") if isinstance(sources, dict) else None
             ticks = node.get("ticks") if isinstance(node, dict) else None
-            if isinstance(ticks, list):
-                _RECORDED_TICKS = [tick for tick in ticks if _validate_tick(tick)]
+            if isinstance(ticks, list) and node.get("schemaVersion") == _SCHEMA_VERSION:
+                _RECORDED_AT = _array("d", [float(tick["at"]) for tick in ticks])
+            elif isinstance(ticks, list):
+                # Non-positive sleeps are no longer recorded; older recordings stored them as 0.0.
+                _RECORDED_AT = _array(
+                    "d",
+                    (tick["at"] for tick in ticks if _validate_tick(tick) and tick.get("seconds") != 0),
+                )
         except Exception as exc:  # noqa: BLE001
             _write_stderr(f"[dal-runtime-python] failed to load clock: {exc}\n")
 
+        _RECORDED_LEN = len(_RECORDED_AT) if _RECORDED_AT is not None else 0
+
+
+
+def _resolve_clock_file() -> _Path:
+    return _Path(_CLOCK_ENV) if _CLOCK_ENV else _Path.cwd() / ".agent" / "clock.json"
+
+
+
+def _expected_ticks() -> int:
+    if not _EXPECTED_TICKS_ENV:
+        return 0
+
+    try:
+        return min(max(int(_EXPECTED_TICKS_ENV), 0), _MAX_EXPECTED_TICKS)
+    except ValueError:
+        return 0
+
+
+
+def _reserve_ticks(count: int) -> None:
+    missing = count - len(_TICK_AT)
+    if missing <= 0:
+        return
+
+    padding = bytes(_TICK_AT.itemsize * missing)
+    _TICK_SECONDS.frombytes(padding)
+    _TICK_AT.frombytes(padding)
+
 
 
 def _seed_random() -> None:
-    seed_value = _os.environ.get("AGENT_SEED")
-    if not seed_value:
+    if not _SEED_ENV:
         return
 
     try:
-        seed_int = int(seed_value)
+        seed_int = int(_SEED_ENV)
     except ValueError:
         return
 
@@ -103,90 +179,173 @@ def _seed_random() -> None:
 
 
 def _patch_time_functions() -> None:
-    # Preserve originals for potential debugging.
-    original_sleep = _time.sleep
-    original_time = _time.time
-    original_monotonic = _time.monotonic
-
     def deterministic_time() -> float:
-        with _LOCK:
-            return _BASE_SECONDS + _VIRTUAL_OFFSET
+        return _BASE_SECONDS + _VIRTUAL_OFFSET
 
     def deterministic_monotonic() -> float:
-        with _LOCK:
-            return _MONOTONIC_BASE + _VIRTUAL_OFFSET
+        return _MONOTONIC_BASE + _VIRTUAL_OFFSET
 
     def deterministic_sleep(seconds: float) -> None:
-        _advance(seconds if seconds else 0.0)
-
-    def deterministic_datetime_now(tz: _Optional[_dt.tzinfo] = None) -> _dt.datetime:
-        base = _BASE_DT or _dt.datetime.now(_dt.timezone.utc)
-        with _LOCK:
-            result = base + _dt.timedelta(seconds=_VIRTUAL_OFFSET)
-        return result if tz is None else result.astimezone(tz)
-
-    def deterministic_datetime_utcnow() -> _dt.datetime:
-        base = _BASE_DT or _dt.datetime.now(_dt.timezone.utc)
-        with _LOCK:
-            return (base + _dt.timedelta(seconds=_VIRTUAL_OFFSET)).replace(tzinfo=None)
+        # sleep(0) is a cooperative yield and negative sleeps used to clamp to 0; neither
+        # moves virtual time, so neither is recorded.
+        if seconds <= 0:
+            return
+        _advance(seconds)
 
     _time.sleep = deterministic_sleep  # type: ignore[assignment]
     _time.time = deterministic_time  # type: ignore[assignment]
     _time.monotonic = deterministic_monotonic  # type: ignore[assignment]
 
-    _dt.datetime.now = staticmethod(deterministic_datetime_now)  # type: ignore[assignment]
-    _dt.datetime.utcnow = staticmethod(deterministic_datetime_utcnow)  # type: ignore[assignment]
+    # datetime.datetime is an immutable C type, so swap in a subclass instead of patching it.
+    _dt.datetime = _DeterministicDatetime  # type: ignore[misc]
+    # Datetimes created before install would otherwise fail pickle's datetime.datetime identity check.
+    _copyreg.pickle(_REAL_DATETIME, _reduce_datetime)
+
+
+class _DeterministicDatetimeMeta(type):
+    # Keep isinstance()/issubclass() working for datetimes created before install. Only the
+    # swapped-in class itself is widened; subclasses defined after install check normally.
+    def __instancecheck__(cls, instance: _Any) -> bool:
+        if cls is _DeterministicDatetime:
+            return isinstance(instance, _REAL_DATETIME)
+        return type.__instancecheck__(cls, instance)
+
+    def __subclasscheck__(cls, subclass: type) -> bool:
+        if cls is _DeterministicDatetime:
+            return issubclass(subclass, _REAL_DATETIME)
+        return type.__subclasscheck__(cls, subclass)
+
+
+class _DeterministicDatetime(_REAL_DATETIME, metaclass=_DeterministicDatetimeMeta):
+    """``datetime.datetime`` whose ``now()`` and ``utcnow()`` read the virtual clock.
+
+    Subclasses of ``datetime.datetime`` defined after install inherit its metaclass. One that
+    declares its own metaclass must derive it from ``type(datetime.datetime)``; a plain
+    ``abc.ABCMeta`` raises a metaclass conflict.
+    """
+
+    def __new__(cls, *args: _Any, **kwargs: _Any) -> _dt.datetime:
+        # Construct plain datetimes, so constructors, fromtimestamp()/strptime() (which call
+        # cls) and the copyreg reducer used by copy and pickle never leak the subclass.
+        if cls is _DeterministicDatetime:
+            return _REAL_DATETIME(*args, **kwargs)
+        return super().__new__(cls, *args, **kwargs)
+
+    @classmethod
+    def now(cls, tz: _Optional[_dt.tzinfo] = None) -> _dt.datetime:  # type: ignore[override]
+        offset = _VIRTUAL_OFFSET
+        if tz is None:
+            return _virtual_now(offset)[0]
 
-    def restore_originals() -> None:
-        _time.sleep = original_sleep  # type: ignore[assignment]
-        _time.time = original_time  # type: ignore[assignment]
-        _time.monotonic = original_monotonic  # type: ignore[assignment]
+        cached = _TZ_NOW_CACHE.get(id(tz))
+        if cached is not None and cached[0] is tz and cached[1] == offset:
+            return cached[2]
+
+        result = _virtual_now(offset)[0].astimezone(tz)
+        if len(_TZ_NOW_CACHE) >= _TZ_NOW_CACHE_SIZE:
+            _TZ_NOW_CACHE.clear()
+        _TZ_NOW_CACHE[id(tz)] = (tz, offset, result)
+        return result
+
+    @classmethod
+    def utcnow(cls) -> _dt.datetime:  # type: ignore[override]
+        return _virtual_now(_VIRTUAL_OFFSET)[1]
+
+
+# Pickle references classes by module and qualified name. Present the subclass under the name it
+# replaces, so payloads say datetime.datetime and load in processes without the shim.
+_DeterministicDatetime.__module__ = "datetime"
+_DeterministicDatetime.__name__ = _DeterministicDatetime.__qualname__ = "datetime"
+
+
+def _reduce_datetime(value: _dt.datetime) -> tuple[_Any, ...]:
+    return (_DeterministicDatetime, value.__reduce__()[1])
+
+
+def _virtual_now(offset: float) -> tuple[_dt.datetime, _dt.datetime]:
+    """Return the aware and naive UTC datetimes for ``offset``, reusing the last result."""
+
+    global _NOW_CACHE
+
+    cached = _NOW_CACHE
+    if cached is not None and cached[0] == offset:
+        return cached[1], cached[2]
+
+    # Exact datetime arithmetic: a float POSIX timestamp near 1.7e9 cannot hold every microsecond.
+    base = _BASE_DT or _REAL_DATETIME.now(_dt.timezone.utc)
+    aware = base + _dt.timedelta(seconds=offset)
+    naive = aware.replace(tzinfo=None)
+    if _BASE_DT is not None:
+        _NOW_CACHE = (offset, aware, naive)
+    return aware, naive
 
-    atexit.register(restore_originals)
 
 
 def _advance(seconds: float) -> None:
-    global _VIRTUAL_OFFSET, _TICK_INDEX
+    global _VIRTUAL_OFFSET, _TICK_INDEX, _TICK_COUNT, _NOW_CACHE
 
     seconds = float(seconds)
-    if seconds < 0:
-        seconds = 0.0
 
-    with _LOCK:
-        if _RECORDED_TICKS is not None:
-            if _TICK_INDEX >= len(_RECORDED_TICKS):
-                raise RuntimeError(
-                    "[dal-runtime-python] replay exceeded recorded clock ticks; diverging schedule detected"
-                )
-            expected = _RECORDED_TICKS[_TICK_INDEX]
+    with _TICK_LOCK:
+        if _RECORDED_AT is not None:
+            if _TICK_INDEX >= _RECORDED_LEN:
+                raise RuntimeError(_REPLAY_EXHAUSTED)
+            at_ms = _RECORDED_AT[_TICK_INDEX]
             _TICK_INDEX += 1
-            at_ms = float(expected.get("at", _VIRTUAL_OFFSET * 1000.0))
             _VIRTUAL_OFFSET = at_ms / 1000.0
         else:
             _VIRTUAL_OFFSET += seconds
             at_ms = _VIRTUAL_OFFSET * 1000.0
 
-        tick = {
-            "sequence": len(_EMITTED_TICKS),
-            "op": "sleep",
-            "seconds": seconds,
-            "at": at_ms
-        }
-        _EMITTED_TICKS.append(tick)
+        sequence = _TICK_COUNT
+        if sequence == len(_TICK_AT):
+            _reserve_ticks(sequence + max(sequence, _TICK_CHUNK))
+        _TICK_SECONDS[sequence] = seconds
+        _TICK_AT[sequence] = at_ms
+        _TICK_COUNT = sequence + 1
+        _NOW_CACHE = None
+        _TZ_NOW_CACHE.clear()
+
+
+
+def flush() -> None:
+    """Persist recorded clock ticks, or report unconsumed ones when replaying.
+
+    Harnesses should call this before the agent exits; the exit hook only runs it
+    again if ticks were emitted since the last call.
+    """
+
+    global _FLUSHED_TICKS
+
+    if _CLOCK_FILE is None:
+        return
+
+    with _LOCK:
+        count = _TICK_COUNT
+        if _MODE == "replay":
+            _verify_replay_consumed()
+        elif not _persist_clock():
+            # Leave the marker alone so the exit hook retries the write.
+            return
+        _FLUSHED_TICKS = count
 
 
 
 def _register_persist() -> None:
-    if _MODE == "replay":
-        atexit.register(_verify_replay_consumed)
+    atexit.register(_flush_at_exit)
+
+
+
+def _flush_at_exit() -> None:
+    if _FLUSHED_TICKS == _TICK_COUNT:
         return
 
-    atexit.register(_persist_clock)
+    flush()
 
 
-def _persist_clock() -> None:
+def _persist_clock() -> bool:
     if _CLOCK_FILE is None:
-        return
+        return False
 
     payload: _Dict[str, _Any] = {
         "version": 1,
@@ -197,8 +356,7 @@ def _persist_clock() -> None:
     existing: _Dict[str, _Any] | None = None
     try:
         if _CLOCK_FILE.exists():
-            existing_raw = _CLOCK_FILE.read_text(encoding="utf-8")
-            existing = _json.loads(existing_raw) if existing_raw else {}
+            existing = _load_json(_CLOCK_FILE)
     except Exception as exc:  # noqa: BLE001
         _write_stderr(f"[dal-runtime-python] could not read existing clock: {exc}\n")
         existing = None
@@ -216,37 +374,102 @@ def _persist_clock() -> None:
         payload["initialTime"] = _INITIAL_TIME_ISO
 
     sources["python"] = {
-        "ticks": list(_EMITTED_TICKS),
+        "schemaVersion": _SCHEMA_VERSION,
+        "ticks": _emitted_ticks(),
         "recordedAt": _dt.datetime.utcnow().replace(tzinfo=_dt.timezone.utc).isoformat().replace("+00:00", "Z"),
         "mode": _MODE
     }
 
     try:
         _CLOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
-        _CLOCK_FILE.write_text(_json.dumps(payload, indent=2) + "\n", encoding="utf-8")
+        _write_atomic(_CLOCK_FILE, _dump_json(payload))
     except Exception as exc:  # noqa: BLE001
         _write_stderr(f"[dal-runtime-python] failed to persist clock: {exc}\n")
+        return False
+
+    return True
+
+
+
+def _write_atomic(path: _Path, data: bytes) -> None:
+    """Write ``data`` to a sibling temp file and rename it over ``path``."""
+
+    tmp_path = path.with_name(f"{path.name}.{_os.getpid()}.tmp")
+    # 0o666 leaves the final permissions to the umask, as Path.write_bytes did.
+    fd = _os.open(tmp_path, _os.O_WRONLY | _os.O_CREAT | _os.O_TRUNC, 0o666)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                written = _os.write(fd, view)
+                view = view[written:]
+            _os.fsync(fd)
+        finally:
+            _os.close(fd)
+        _os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
 
 
+def _emitted_ticks() -> _List[_Dict[str, _Any]]:
+    return [
+        {"sequence": index, "op": "sleep", "seconds": seconds, "at": at_ms}
+        for index, seconds, at_ms in zip(range(_TICK_COUNT), _TICK_SECONDS, _TICK_AT)
+    ]
+
+
+
+def _load_json(path: _Path) -> _Any:
+    if _orjson is not None:
+        raw = path.read_bytes()
+        return _orjson.loads(raw) if raw else {}
+
+    raw_text = path.read_text(encoding="utf-8")
+    return _json.loads(raw_text) if raw_text else {}
+
+
+
+def _dump_json(payload: _Dict[str, _Any]) -> bytes:
+    if _orjson is not None:
+        return _orjson.dumps(payload, option=_orjson.OPT_INDENT_2 | _orjson.OPT_NON_STR_KEYS) + b"\n"
+
+    return (_json.dumps(payload, indent=2) + "\n").encode("utf-8")
+
+
+
+# Missing or invalid values memoise their real-time fallback, so repeat parses agree on one base.
+@_functools.lru_cache(maxsize=8)
 def _parse_iso_timestamp(value: _Optional[str]) -> _dt.datetime:
     if not value:
-        return _dt.datetime.now(_dt.timezone.utc)
-
-    iso_value = value.strip()
-    if iso_value.endswith("Z"):
-        iso_value = iso_value[:-1] + "+00:00"
+        return _REAL_DATETIME.now(_dt.timezone.utc)
 
     try:
-        parsed = _dt.datetime.fromisoformat(iso_value)
+        parsed = _fromisoformat(value)
         if parsed.tzinfo is None:
             parsed = parsed.replace(tzinfo=_dt.timezone.utc)
         return parsed.astimezone(_dt.timezone.utc)
     except ValueError:
-        return _dt.datetime.now(_dt.timezone.utc)
+        return _REAL_DATETIME.now(_dt.timezone.utc)
+
+
+
+def _fromisoformat(value: str) -> _dt.datetime:
+    if _NATIVE_ISO_PARSE:
+        try:
+            return _REAL_DATETIME.fromisoformat(value)
+        except ValueError:
+            pass
 
+    iso_value = value.strip()
+    if iso_value.endswith("Z"):
+        iso_value = iso_value[:-1] + "+00:00"
+    return _REAL_DATETIME.fromisoformat(iso_value)
 
 
+
+@_functools.lru_cache(maxsize=8)
 def _normalise_mode(value: _Optional[str]) -> str:
     if value and value.lower() == "replay":
         return "replay"
@@ -255,11 +478,11 @@ def _normalise_mode(value: _Optional[str]) -> str:
 
 
 def _validate_tick(tick: _Any) -> bool:
-    return (
-        isinstance(tick, dict)
-        and tick.get("op") == "sleep"
-        and isinstance(tick.get("at"), (int, float))
-    )
+    # Decoded JSON only yields exact int/float, so an identity check on the type suffices.
+    try:
+        return tick["op"] == "sleep" and type(tick["at"]) in (int, float)
+    except (TypeError, KeyError, IndexError):
+        return False
 
 
 
@@ -271,10 +494,10 @@ def _write_stderr(message: str) -> None:
 
 
 def _verify_replay_consumed() -> None:
-    if _RECORDED_TICKS is None:
+    if _RECORDED_AT is None:
         return
 
-    remaining = len(_RECORDED_TICKS) - _TICK_INDEX
+    remaining = _RECORDED_LEN - _TICK_INDEX
     if remaining:
         _write_stderr(
             f"[dal-runtime-python] replay did not consume {remaining} recorded clock ticks\n"
@@ -0,0 +1,473 @@
+"""Subprocess tests for the dal_runtime deterministic shim.
+
+dal_runtime patches the interpreter at import, so every case runs in a fresh process.
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[4]
+START_TIME = "2024-01-01T00:00:00Z"
+
+
+class DalRuntimeTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.workdir = Path(self._tmp.name)
+        self.clock_file = self.workdir / ".agent" / "clock.json"
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    def run_agent(self, script: str, **overrides: str) -> subprocess.CompletedProcess[str]:
+        env = {key: value for key, value in os.environ.items() if not key.startswith("AGENT_")}
+        env.update(
+            PYTHONPATH=str(REPO_ROOT),
+            AGENT_DETERMINISTIC="1",
+            AGENT_START_TIME=START_TIME,
+            AGENT_CLOCK_FILE=str(self.clock_file),
+        )
+        env.update(overrides)
+        return subprocess.run(
+            [sys.executable, "-c", textwrap.dedent(script)],
+            cwd=self.workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+
+    def assert_ok(self, result: subprocess.CompletedProcess[str]) -> None:
+        self.assertEqual(result.returncode, 0, msg=result.stderr)
+
+    def python_ticks(self) -> list[dict]:
+        clock = json.loads(self.clock_file.read_text(encoding="utf-8"))
+        return clock["sources"]["python"]["ticks"]
+
+
+class InstallTests(DalRuntimeTestCase):
+    def test_install_patches_clock_and_datetime(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            real_now = datetime.datetime(2020, 1, 1)
+
+            import dal_runtime
+            import time
+
+            time.sleep(1.5)
+            print(time.time())
+            print(datetime.datetime.now().isoformat())
+            print(datetime.datetime.utcnow().isoformat())
+            print(isinstance(real_now, datetime.datetime))
+            """
+        )
+
+        self.assert_ok(result)
+        epoch, now, utcnow, isinstance_ok = result.stdout.split()
+        self.assertEqual(float(epoch), 1704067201.5)
+        self.assertEqual(now, "2024-01-01T00:00:01.500000+00:00")
+        self.assertEqual(utcnow, "2024-01-01T00:00:01.500000")
+        self.assertEqual(isinstance_ok, "True")
+
+    def test_subclasses_defined_after_install_check_normally(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            before = datetime.datetime(2020, 1, 1)
+
+            import abc
+            import dal_runtime
+
+            class Sub(datetime.datetime):
+                pass
+
+            print(isinstance(before, datetime.datetime), issubclass(type(before), datetime.datetime))
+            print(isinstance(before, Sub), issubclass(type(before), Sub))
+            print(isinstance(Sub(2020, 1, 1), Sub), isinstance(Sub(2020, 1, 1), datetime.datetime))
+
+            try:
+                class Abstract(datetime.datetime, metaclass=abc.ABCMeta):
+                    pass
+            except TypeError:
+                print("conflict")
+
+            class Meta(type(datetime.datetime), abc.ABCMeta):
+                pass
+
+            class Combined(datetime.datetime, metaclass=Meta):
+                pass
+
+            print(isinstance(Combined(2020, 1, 1), datetime.datetime), isinstance(before, Combined))
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(
+            result.stdout.splitlines(),
+            ["True True", "False False", "True True", "conflict", "True False"],
+        )
+
+    def test_datetimes_pickle_as_the_real_class(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            before = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+            import dal_runtime
+            import pickle
+
+            values = [before, datetime.datetime(2020, 1, 2), datetime.datetime.strptime("2020-01-03", "%Y-%m-%d")]
+            for protocol in (0, pickle.HIGHEST_PROTOCOL):
+                print(pickle.dumps(values, protocol).hex())
+            """
+        )
+
+        self.assert_ok(result)
+        for line in result.stdout.split():
+            payload = bytes.fromhex(line)
+            self.assertNotIn(b"_DeterministicDatetime", payload)
+            values = pickle.loads(payload)
+            self.assertEqual([type(value) for value in values], [datetime.datetime] * 3)
+            self.assertEqual(values[2], datetime.datetime(2020, 1, 3))
+
+    def test_constructors_and_copies_return_the_real_class(self) -> None:
+        result = self.run_agent(
+            """
+            from datetime import datetime as real_class
+            before = real_class(2020, 1, 1)
+
+            import copy
+            import datetime
+            import dal_runtime
+            import pickle
+
+            class Sub(datetime.datetime):
+                pass
+
+            values = [
+                datetime.datetime(2020, 1, 1),
+                datetime.datetime.fromtimestamp(0),
+                datetime.datetime.strptime("2020-01-03", "%Y-%m-%d"),
+                copy.copy(before),
+                copy.deepcopy(before),
+                pickle.loads(pickle.dumps(before)),
+            ]
+            print(all(type(value) is real_class for value in values))
+            print(repr(values[0]))
+            print(repr(Sub(2020, 1, 1)), type(copy.deepcopy(Sub(2020, 1, 1))).__name__)
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(
+            result.stdout.splitlines(),
+            ["True", "datetime.datetime(2020, 1, 1, 0, 0)", "Sub(2020, 1, 1, 0, 0) Sub"],
+        )
+
+    def test_datetime_now_follows_sleeps(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            import dal_runtime
+            import time
+
+            first = datetime.datetime.now()
+            assert datetime.datetime.now() == first
+            time.sleep(2)
+            print((datetime.datetime.now() - first).total_seconds())
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.strip(), "2.0")
+
+    def test_aware_now_is_cached_per_tzinfo_object(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            import dal_runtime
+            import time
+
+            class Unhashable(datetime.tzinfo):
+                __hash__ = None
+
+                def utcoffset(self, dt):
+                    return datetime.timedelta(hours=2)
+
+                def tzname(self, dt):
+                    return "C"
+
+                def dst(self, dt):
+                    return datetime.timedelta(0)
+
+            two_hours = datetime.timedelta(hours=2)
+            zones = [datetime.timezone(two_hours, "A"), datetime.timezone(two_hours, "B"), Unhashable()]
+            for _ in range(2):
+                print(" ".join(datetime.datetime.now(tz).strftime("%H:%M:%S%Z") for tz in zones))
+                time.sleep(1)
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(
+            result.stdout.splitlines(),
+            ["02:00:00A 02:00:00B 02:00:00C", "02:00:01A 02:00:01B 02:00:01C"],
+        )
+
+    def test_aware_now_cache_stays_bounded_between_sleeps(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            from packages.replay.python import dal_runtime
+
+            hour = datetime.timedelta(hours=1)
+            for _ in range(1000):
+                datetime.datetime.now(datetime.timezone(hour))
+            print(len(dal_runtime._TZ_NOW_CACHE) <= dal_runtime._TZ_NOW_CACHE_SIZE)
+
+            tz = datetime.timezone(hour)
+            print(datetime.datetime.now(tz) is datetime.datetime.now(tz))
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.split(), ["True", "True"])
+
+    def test_datetime_now_matches_exact_base_arithmetic(self) -> None:
+        # A float POSIX timestamp rounds this offset one microsecond away from base + timedelta.
+        result = self.run_agent(
+            """
+            import datetime
+            import dal_runtime
+            import time
+
+            time.sleep(25.50690257394217)
+            print(datetime.datetime.now().isoformat())
+            print(datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).isoformat())
+            """,
+            AGENT_START_TIME="2024-03-05T10:11:12.123456Z",
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(
+            result.stdout.split(),
+            ["2024-03-05T10:11:37.630359+00:00", "2024-03-05T12:11:37.630359+02:00"],
+        )
+
+    def test_record_then_replay(self) -> None:
+        script = """
+            import dal_runtime
+            import time
+
+            time.sleep(1)
+            time.sleep(0.25)
+            print(time.monotonic())
+            """
+
+        recorded = self.run_agent(script)
+        self.assert_ok(recorded)
+        self.assertEqual([tick["at"] for tick in self.python_ticks()], [1000.0, 1250.0])
+        self.assertEqual(sorted(path.name for path in self.clock_file.parent.iterdir()), ["clock.json"])
+
+        replayed = self.run_agent(script, AGENT_EXECUTION_MODE="replay")
+        self.assert_ok(replayed)
+        self.assertEqual(replayed.stdout, recorded.stdout)
+        self.assertEqual(replayed.stderr, "")
+
+    def test_flush_persists_and_exit_hook_skips_rewrite(self) -> None:
+        result = self.run_agent(
+            """
+            import dal_runtime
+            import json
+            import os
+            import time
+
+            time.sleep(1)
+            dal_runtime.flush()
+            clock_file = os.environ["AGENT_CLOCK_FILE"]
+            with open(clock_file, encoding="utf-8") as handle:
+                print(json.load(handle)["sources"]["python"]["ticks"][0]["at"])
+            os.remove(clock_file)
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.strip(), "1000.0")
+        self.assertFalse(self.clock_file.exists())
+
+    def test_exit_hook_retries_failed_flush(self) -> None:
+        result = self.run_agent(
+            """
+            import dal_runtime
+            import os
+            import time
+
+            clock_file = os.environ["AGENT_CLOCK_FILE"]
+            os.makedirs(clock_file)
+            time.sleep(1)
+            dal_runtime.flush()
+            os.rmdir(clock_file)
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertIn("failed to persist clock", result.stderr)
+        self.assertEqual([tick["at"] for tick in self.python_ticks()], [1000.0])
+
+    def test_failed_rename_removes_temp_file(self) -> None:
+        self.clock_file.mkdir(parents=True)
+        result = self.run_agent(
+            """
+            import dal_runtime
+            import time
+
+            time.sleep(1)
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertIn("failed to persist clock", result.stderr)
+        self.assertEqual(sorted(path.name for path in self.clock_file.parent.iterdir()), ["clock.json"])
+
+    def test_clock_file_permissions_follow_umask(self) -> None:
+        result = self.run_agent(
+            """
+            import os
+            os.umask(0o002)
+
+            import dal_runtime
+            import time
+
+            time.sleep(1)
+            """
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(self.clock_file.stat().st_mode & 0o777, 0o664)
+
+    def test_tick_columns_are_presized_and_grow_geometrically(self) -> None:
+        result = self.run_agent(
+            """
+            from packages.replay.python import dal_runtime
+            import time
+
+            print(len(dal_runtime._TICK_AT))
+            for _ in range(11):
+                time.sleep(1)
+            print(len(dal_runtime._TICK_AT))
+            for _ in range(dal_runtime._TICK_CHUNK):
+                time.sleep(1)
+            print(len(dal_runtime._TICK_AT))
+            """,
+            AGENT_EXPECTED_TICKS="10",
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.split(), ["10", str(10 + 4096), str(2 * (10 + 4096))])
+        ticks = self.python_ticks()
+        self.assertEqual(len(ticks), 11 + 4096)
+        self.assertEqual(ticks[-1], {"sequence": 4106, "op": "sleep", "seconds": 1.0, "at": 4107000.0})
+
+    def test_expected_ticks_presize_is_capped(self) -> None:
+        result = self.run_agent(
+            """
+            from packages.replay.python import dal_runtime
+            import time
+
+            time.sleep(1)
+            print(len(dal_runtime._TICK_AT) == dal_runtime._MAX_EXPECTED_TICKS)
+            """,
+            AGENT_EXPECTED_TICKS="100000000000",
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.strip(), "True")
+        self.assertEqual([tick["at"] for tick in self.python_ticks()], [1000.0])
+
+    def test_replays_legacy_recording_with_clamped_negative_sleep(self) -> None:
+        legacy_ticks = [
+            {"sequence": 0, "op": "sleep", "seconds": 1.0, "at": 1000.0},
+            {"sequence": 1, "op": "sleep", "seconds": 0.0, "at": 1000.0},
+            {"sequence": 2, "op": "sleep", "seconds": 2.0, "at": 3000.0},
+        ]
+        self.clock_file.parent.mkdir(parents=True)
+        self.clock_file.write_text(
+            json.dumps({"version": 1, "initialTime": START_TIME, "sources": {"python": {"ticks": legacy_ticks}}}),
+            encoding="utf-8",
+        )
+
+        result = self.run_agent(
+            """
+            import dal_runtime
+            import time
+
+            time.sleep(1)
+            time.sleep(-1)
+            time.sleep(2)
+            print(time.monotonic())
+            """,
+            AGENT_EXECUTION_MODE="replay",
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.strip(), "3.0")
+        self.assertEqual(result.stderr, "")
+
+
+class VirtualTimeTests(DalRuntimeTestCase):
+    def test_now_matches_installed_datetime_clock(self) -> None:
+        result = self.run_agent(
+            """
+            import datetime
+            real_class = datetime.datetime
+
+            import dal_runtime
+            import time
+            from packages.replay.python import virtual_time
+
+            time.sleep(25.50690257394217)
+            now = virtual_time.now()
+            print(now.isoformat())
+            print(now == datetime.datetime.now(datetime.timezone.utc))
+            print(type(now) is real_class)
+            """,
+            AGENT_START_TIME="2024-03-05T10:11:12.123456Z",
+        )
+
+        self.assert_ok(result)
+        self.assertEqual(result.stdout.split(), ["2024-03-05T10:11:37.630359+00:00", "True", "True"])
+
+    def test_now_advances_start_time_by_real_elapsed_time(self) -> None:
+        result = self.run_agent(
+            """
+            from packages.replay.python import virtual_time
+
+            first = virtual_time.now()
+            second = virtual_time.now()
+            print(first.isoformat())
+            print(second.isoformat())
+            """,
+            AGENT_DETERMINISTIC="0",
+        )
+
+        self.assert_ok(result)
+        start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        first, second = (datetime.datetime.fromisoformat(line) for line in result.stdout.split())
+        self.assertLessEqual(start, first)
+        self.assertLessEqual(first, second)
+        self.assertLess(second - start, datetime.timedelta(seconds=30))
+
+
+if __name__ == "__main__":
+    unittest.main()
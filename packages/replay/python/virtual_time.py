@@ -7,7 +7,7 @@ import os as _os
 import time as _time
 
 _START_ISO = _os.environ.get("AGENT_START_TIME")
-_MONOTONIC_START = _time.monotonic()
+_MONOTONIC_START_NS = _time.perf_counter_ns()
 
 if _START_ISO is None:
     _BASE: _dt.datetime | None = None
@@ -21,14 +21,21 @@ else:
 def now() -> _dt.datetime:
     """Return the current virtual time.
 
-    Falls back to real UTC time when no AGENT_START_TIME is defined.
+    Reads the deterministic clock when dal_runtime is installed, otherwise advances
+    AGENT_START_TIME by real elapsed time. Falls back to real UTC time when no
+    AGENT_START_TIME is defined.
     """
 
+    if getattr(_time, "__dal_installed__", None) is not None:
+        # datetime.datetime is dal_runtime's subclass here: its now() applies the exact
+        # base + timedelta arithmetic and memoisation, and returns a plain UTC datetime.
+        return _dt.datetime.now(_dt.timezone.utc)
+
     if _BASE is None:
         return _dt.datetime.now(_dt.timezone.utc)
 
-    elapsed = _time.monotonic() - _MONOTONIC_START
-    return _BASE + _dt.timedelta(seconds=elapsed)
+    delta_ns = _time.perf_counter_ns() - _MONOTONIC_START_NS
+    return _BASE + _dt.timedelta(microseconds=delta_ns // 1000)
 
 
 __all__ = ["now"]